@@ -14,6 +14,10 @@ from docx import Document as DocReader
 from pdf2image import convert_from_path
 from transformers import TrOCRProcessor, VisionEncoderDecoderModel
 import torch
+from cpu_scheduler import configure_current_process, run_pipeline
+from page_buffers import iter_pdf_pages
+from ocr_layout import (LAYOUT_FORMATS, extract_page_layout, layout_to_text, save_layout_outputs, save_layout_bundle,
+                        save_page_images)
 
 # ========== Flask Setup ==========
 app = Flask(__name__)
@@ -21,16 +25,23 @@ UPLOAD_FOLDER = 'uploads'
 OUTPUT_FOLDER = 'outputs'
 FONT_PATH = 'static/fonts/DejaVuSans.ttf'
 POPDIR = r'D:/propeller/poppler-24.08.0/Library/bin'
+DPI = 300
 pytesseract.pytesseract.tesseract_cmd = r'D:/tesseract/tesseract.exe'
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
 # ========== TrOCR Setup ==========
-processor = TrOCRProcessor.from_pretrained("microsoft/trocr-base-printed")
-model = VisionEncoderDecoderModel.from_pretrained("microsoft/trocr-base-printed")
-device = "cuda" if torch.cuda.is_available() else "cpu"
-model.to(device)
+# Schedule from `python cpu_scheduler.py autotune --invert`, if one was saved: PDF layout jobs run
+# through its worker pools (created once per server process), everything else in this process
+# with the whole thread budget; with $WEB_CONCURRENCY server processes each gets its share
+SCHEDULE = configure_current_process()
+# Spawned pool workers re-import this module as __mp_main__ and load their own replica
+if __name__ != "__mp_main__":
+    processor = TrOCRProcessor.from_pretrained("microsoft/trocr-base-printed")
+    model = VisionEncoderDecoderModel.from_pretrained("microsoft/trocr-base-printed")
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model.to(device)
 
 # ========== Helpers ==========
 def clean_text(text):
@@ -66,13 +77,18 @@ def save_to_docx_with_images(text, image_paths, filename):
     doc.save(filename)
 
 # ========== OCR Methods ==========
+def trocr_read_lines(line_imgs):
+    batch = []
+    for line_img in line_imgs:
+        img = line_img.convert("RGB")
+        batch.append(img.resize((img.width * 2, img.height * 2)))
+    pixel_values = processor(images=batch, return_tensors="pt").pixel_values.to(device)
+    with torch.no_grad():
+        generated_ids = model.generate(pixel_values)
+    return processor.batch_decode(generated_ids, skip_special_tokens=True)
+
 def extract_text_from_image_trocr(image_path):
-    img = Image.open(image_path).convert("RGB")
-    img = img.resize((img.width * 2, img.height * 2))
-    pixel_values = processor(images=img, return_tensors="pt").pixel_values.to(device)
-    generated_ids = model.generate(pixel_values)
-    trocr_text = processor.batch_decode(generated_ids, skip_special_tokens=True)[0]
-    return trocr_text + "\n\n[via TrOCR]"
+    return trocr_read_lines([Image.open(image_path)])[0] + "\n\n[via TrOCR]"
 
 def extract_text_from_image_tesseract(image_path, lang='eng'):
     img = Image.open(image_path).convert("L")
@@ -84,7 +100,7 @@ def extract_text_from_image_tesseract(image_path, lang='eng'):
 def extract_text_and_images_from_pdf(pdf_path, lang='eng'):
     text = ""
     image_files = []
-    pages = convert_from_path(pdf_path, dpi=300, poppler_path=POPDIR)
+    pages = convert_from_path(pdf_path, dpi=DPI, poppler_path=POPDIR)
 
     for i, page in enumerate(pages):
         page_img_path = os.path.join(OUTPUT_FOLDER, f"page_{i+1}.png")
@@ -113,6 +129,28 @@ def extract_text_and_images_from_pdf(pdf_path, lang='eng'):
 
     return text.strip(), image_files
 
+def extract_layout_from_pdf(pdf_path, lang='eng'):
+    pages = iter_pdf_pages(pdf_path, dpi=DPI, poppler_path=POPDIR)
+
+    if SCHEDULE is None:
+        layouts, page_paths = [], []
+        for i, page in enumerate(pages):
+            page_paths.append(save_page_images(np.asarray(page), i, OUTPUT_FOLDER)[0])
+            layouts.append(extract_page_layout(page, page_number=i + 1, lang=lang, invert=True,
+                                               line_recognizer=trocr_read_lines))
+    else:
+        # Page PNGs are saved by the pool workers from the shared page buffers
+        layouts, saved = run_pipeline(pages, SCHEDULE, lang=lang, invert=True, keep_pools=True,
+                                      save_folder=OUTPUT_FOLDER)
+        page_paths = [page_path for page_path, _ in saved]
+
+    return layouts, page_paths
+
+def extract_layout_from_image(image_path, lang='eng'):
+    img = Image.open(image_path)
+    layout = extract_page_layout(img, lang=lang, invert=True, line_recognizer=trocr_read_lines)
+    return [layout], [image_path]
+
 def extract_text_from_docx(docx_path):
     doc = DocReader(docx_path)
     text = "\n".join([p.text for p in doc.paragraphs])
@@ -136,10 +174,34 @@ def index():
         base_name = os.path.splitext(filename)[0]
         ext = filename.lower().split('.')[-1]
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        output_name = f"{base_name}_{timestamp}.{output_format}"
+        if output_format in LAYOUT_FORMATS:
+            output_name = f"{base_name}_{timestamp}{LAYOUT_FORMATS[output_format]}"
+        else:
+            output_name = f"{base_name}_{timestamp}.{output_format}"
         output_path = os.path.join(OUTPUT_FOLDER, output_name)
 
         try:
+            if output_format in LAYOUT_FORMATS or output_format == 'zip':
+                # Searchable PDF, hOCR, ALTO and JSON all come from the same word-box pass
+                if ext == 'pdf':
+                    layouts, page_paths = extract_layout_from_pdf(input_path, lang)
+                elif ext in ['jpg', 'jpeg', 'png']:
+                    layouts, page_paths = extract_layout_from_image(input_path, lang)
+                else:
+                    return "Layout output needs a PDF or image input", 400
+                if not layouts:
+                    return "The uploaded PDF has no pages.", 400
+
+                base_path = os.path.join(OUTPUT_FOLDER, f"{base_name}_{timestamp}")
+                layout_paths = save_layout_outputs(layouts, page_paths, base_path, dpi=DPI, font_path=FONT_PATH,
+                                                   source_name=filename)
+                if output_format == 'zip':
+                    txt_path = base_path + ".txt"
+                    save_to_txt(clean_text(layout_to_text(layouts)), txt_path)
+                    layout_paths["txt"] = txt_path
+                    save_layout_bundle(layout_paths, output_path)
+                return send_file(output_path, as_attachment=True, download_name=os.path.basename(output_path))
+
             if ext == 'pdf':
                 text, image_paths = extract_text_and_images_from_pdf(input_path, lang)
             elif ext == 'docx':
@@ -0,0 +1,404 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import argparse
+import threading
+import multiprocessing as mp
+import cv2
+import numpy as np
+import pytesseract
+from PIL import Image
+from pdf2image import convert_from_path
+from transformers import TrOCRProcessor, VisionEncoderDecoderModel
+import torch
+from ocr_layout import extract_page_layout, apply_line_recognizer, save_page_images
+from page_buffers import PageBufferStore
+
+# ========== CONFIG ==========
+SCHEDULE_PATH = "cpu_schedule.json"
+TROCR_MODEL = "microsoft/trocr-base-printed"
+POPDIR = r'D:/propeller/poppler-24.08.0/Library/bin'
+SLOT_TIMEOUT = 5      # seconds a starting worker waits for its slot
+PAGE_TIMEOUT = 600    # seconds without any page finishing before a run is abandoned
+pytesseract.pytesseract.tesseract_cmd = r'D:/tesseract/tesseract.exe'
+
+# ========== Core detection ==========
+def available_cores():
+    # Respect taskset/cgroup limits where the OS exposes them
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def _powers_of_two(limit):
+    n = 1
+    while n <= limit:
+        yield n
+        n *= 2
+
+# ========== Planning ==========
+def plan_schedule(trocr_replicas, tesseract_workers, tesseract_threads=1, cores=None, pin=False):
+    """Split the cores between TrOCR replicas and Tesseract workers.
+
+    Tesseract workers get `tesseract_threads` cores each (OpenMP gains little on
+    a single page), the TrOCR replicas share what is left for torch intra-op
+    threads, the first replicas taking one extra core each until none are left.
+    If there are fewer cores than workers, cores are shared round-robin.
+    """
+    if trocr_replicas < 1 or tesseract_workers < 1 or tesseract_threads < 1:
+        raise ValueError("A schedule needs at least one TrOCR replica, one Tesseract worker and one thread each")
+    cores = list(cores or available_cores())
+    n = len(cores)
+    free = max(n - tesseract_workers * tesseract_threads, 0)
+    trocr_threads = max(1, free // trocr_replicas)
+    spare = max(free - trocr_threads * trocr_replicas, 0)
+
+    slot_threads = [("tesseract", tesseract_threads)] * tesseract_workers
+    slot_threads += [("trocr", trocr_threads + (1 if i < spare else 0)) for i in range(trocr_replicas)]
+
+    workers = []
+    cursor = 0
+    for role, threads in slot_threads:
+        slot = [cores[(cursor + k) % n] for k in range(threads)]
+        workers.append({"role": role, "threads": threads, "cores": sorted(set(slot))})
+        cursor += threads
+
+    return {
+        "trocr_replicas": trocr_replicas,
+        "tesseract_workers": tesseract_workers,
+        "trocr_threads": trocr_threads,
+        "tesseract_threads": tesseract_threads,
+        "pin": pin,
+        "workers": workers,
+    }
+
+def candidate_plans(cores=None, pin=False):
+    cores = list(cores or available_cores())
+    n = len(cores)
+    if n < 2:
+        return [plan_schedule(1, 1, cores=cores, pin=pin)]
+    # Every candidate fits on the cores: replicas + tess * tesseract_threads <= n
+    plans = []
+    for tess_threads in (1, 2, 4):
+        for replicas in _powers_of_two(n - tess_threads):
+            for tess in _powers_of_two((n - replicas) // tess_threads):
+                plans.append(plan_schedule(replicas, tess, tess_threads, cores=cores, pin=pin))
+    return plans
+
+def split_plan(plan, server_workers):
+    """One server process's share of `plan` when `server_workers` of them share the host.
+
+    Replicas, workers and cores are divided (at least one of each per process),
+    and the share is never pinned since the processes cannot agree on cores.
+    """
+    if server_workers <= 1:
+        return plan
+    cores = available_cores()
+    share = cores[:max(1, len(cores) // server_workers)]
+    return plan_schedule(max(1, plan["trocr_replicas"] // server_workers),
+                         max(1, plan["tesseract_workers"] // server_workers),
+                         plan["tesseract_threads"], cores=share, pin=False)
+
+def save_schedule(plan, path=SCHEDULE_PATH):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(plan, f, indent=2)
+
+def load_schedule(path=SCHEDULE_PATH):
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+# ========== Applying a plan ==========
+def apply_worker_limits(role, threads, cores=None, pin=False):
+    # Tesseract is a subprocess of pytesseract, so it inherits both the env and the affinity
+    os.environ["OMP_THREAD_LIMIT"] = str(threads if role == "tesseract" else 1)
+    cv2.setNumThreads(threads)
+    if role == "trocr":
+        torch.set_num_threads(threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass  # can only be set before the first parallel op
+    if pin and cores:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cores)
+        else:
+            print("⚠️ Core pinning is not supported on this OS, running unpinned")
+
+def configure_current_process(path=SCHEDULE_PATH, server_workers=None):
+    """Load the saved schedule and size a process that runs both engines itself.
+
+    Such a process alternates between Tesseract and TrOCR, so it gets the whole
+    budget of each role and is not pinned; the replica/worker split is only
+    used by run_pipeline(). With several server processes (`server_workers`,
+    default $WEB_CONCURRENCY) each one gets its split_plan() share.
+    Returns that plan, or None if none was saved.
+    """
+    plan = load_schedule(path)
+    if plan is None:
+        return None
+    if server_workers is None:
+        server_workers = int(os.environ.get("WEB_CONCURRENCY", 1))
+    plan = split_plan(plan, server_workers)
+    apply_worker_limits("trocr", sum(w["threads"] for w in plan["workers"] if w["role"] == "trocr"))
+    # Threads for the Tesseract subprocesses this process spawns itself
+    os.environ["OMP_THREAD_LIMIT"] = str(sum(w["threads"] for w in plan["workers"] if w["role"] == "tesseract"))
+    return plan
+
+# ========== Worker pools ==========
+_processor = None
+_model = None
+
+def _init_worker(role, slots, pin, fallback):
+    global _processor, _model
+    try:
+        slot = slots.get(timeout=SLOT_TIMEOUT)
+    except queue.Empty:
+        # A replacement for a worker that died: its slot went with it, so run unpinned
+        slot, pin = fallback, False
+    apply_worker_limits(role, slot["threads"], slot["cores"], pin)
+    if role == "trocr":
+        _processor = TrOCRProcessor.from_pretrained(TROCR_MODEL)
+        _model = VisionEncoderDecoderModel.from_pretrained(TROCR_MODEL)
+        _model.to("cpu")
+
+def make_pool(role, plan):
+    workers = [w for w in plan["workers"] if w["role"] == role]
+    slots = mp.Queue()
+    for w in workers:
+        slots.put(w)
+    return mp.Pool(len(workers), initializer=_init_worker, initargs=(role, slots, plan["pin"], workers[0]))
+
+_shared_pools = None
+_shared_pools_lock = threading.Lock()
+
+def shared_pools(plan):
+    """Pools created on first use and kept for the life of the process, e.g. a web server's."""
+    global _shared_pools
+    with _shared_pools_lock:
+        if _shared_pools is None:
+            _shared_pools = (make_pool("tesseract", plan), make_pool("trocr", plan))
+            atexit.register(_close_shared_pools)
+        return _shared_pools
+
+def _close_shared_pools():
+    for pool in _shared_pools:
+        pool.terminate()
+
+def _trocr_read_lines(line_imgs, equalize=False):
+    batch = []
+    for line_img in line_imgs:
+        if equalize:
+            # Same preprocessing as smart_scan_processor.trocr_read_lines
+            img_gray = line_img.convert("L").resize((line_img.width * 2, line_img.height * 2))
+            batch.append(Image.fromarray(cv2.equalizeHist(np.array(img_gray))).convert("RGB"))
+        else:
+            img = line_img.convert("RGB")
+            batch.append(img.resize((img.width * 2, img.height * 2)))
+    pixel_values = _processor(images=batch, return_tensors="pt").pixel_values
+    with torch.no_grad():
+        generated_ids = _model.generate(pixel_values)
+    return _processor.batch_decode(generated_ids, skip_special_tokens=True)
+
+# Pages travel as shared-memory handles, not pickled PIL images
+def tesseract_task(handle, page_number=1, lang='eng', invert=False):
+    try:
+        return extract_page_layout(handle.image(), page_number=page_number, lang=lang, invert=invert)
+    finally:
+        handle.close()
+
+def trocr_task(handle, layout, equalize=False):
+    try:
+        return apply_line_recognizer(handle.image(), layout, lambda imgs: _trocr_read_lines(imgs, equalize))
+    finally:
+        handle.close()
+
+def save_task(handle, page_index, folder, figures=False):
+    try:
+        return save_page_images(handle.view(), page_index, folder, figures)
+    finally:
+        handle.close()
+
+def _run_on_pools(tess_pool, trocr_pool, pages, lang, store, window, invert=False, equalize=False, save=None):
+    """Keep at most `window` pages in the store; the next page is put as each one is freed.
+
+    With `save` = (folder, figures), save_task() runs on the Tesseract pool as a
+    third stage on the same buffer. Returns (layouts, saved), where saved holds
+    the save_task() results, or None per page without `save`.
+    """
+    results = {}
+    saved = {}
+    errors = []
+    free_slots = threading.Semaphore(window)
+    pending_lock = threading.Lock()
+    stages = ("tesseract", "trocr", "save") if save else ("tesseract", "trocr")
+
+    def submit(i, handle):
+        pending = [len(stages)]
+
+        def done(count=1):
+            # Callbacks come from both pools' result threads; the last stage hands the slot back
+            for _ in range(count):
+                store.release(handle)
+            with pending_lock:
+                pending[0] -= count
+                last = pending[0] == 0
+            if last:
+                free_slots.release()
+
+        def on_error(e, skipped=0):
+            errors.append(e)
+            done(1 + skipped)
+
+        def on_trocr(layout):
+            results[i] = layout
+            done()
+
+        def on_layout(layout):
+            done()
+            trocr_pool.apply_async(trocr_task, (handle, layout, equalize),
+                                   callback=on_trocr, error_callback=on_error)
+
+        def on_saved(paths):
+            saved[i] = paths
+            done()
+
+        # A failed Tesseract stage also stands for the TrOCR stage it never submits
+        tess_pool.apply_async(tesseract_task, (handle, i + 1, lang, invert),
+                              callback=on_layout, error_callback=lambda e: on_error(e, skipped=1))
+        if save:
+            tess_pool.apply_async(save_task, (handle, i) + tuple(save),
+                                  callback=on_saved, error_callback=on_error)
+
+    def wait_for_slot():
+        if not free_slots.acquire(timeout=PAGE_TIMEOUT):
+            raise TimeoutError(f"No page finished within {PAGE_TIMEOUT} s, a worker may have died")
+
+    count = 0
+    for i, page in enumerate(pages):
+        wait_for_slot()
+        if errors:
+            free_slots.release()
+            break
+        submit(i, store.put(page, stages=stages))
+        count += 1
+
+    # Every finished or failed page hands its slot back
+    for _ in range(window):
+        wait_for_slot()
+    if errors:
+        raise errors[0]
+    return [results[i] for i in range(count)], [saved.get(i) for i in range(count)]
+
+def _window(plan):
+    return 2 * len(plan["workers"])
+
+def run_pipeline(pages, plan, lang='eng', invert=False, equalize=False, backend="shm", keep_pools=False,
+                 save_folder=None, figures=False):
+    """Tesseract word boxes in one pool, TrOCR line reads in the other, overlapped per page.
+
+    `pages` is any iterable of PIL images (e.g. iter_pdf_pages), consumed as the
+    in-flight window of 2 x workers frees up; `invert` is the Tesseract
+    preprocessing of app.py, `equalize` the TrOCR one of smart_scan_processor.py;
+    `backend` is "shm" or "mmap". With `keep_pools` the shared_pools() of this
+    process are used, so the models load once instead of on every call.
+    With `save_folder` the workers also save each page (and, with `figures`,
+    its picture regions) there, see save_page_images().
+    Returns (layouts, saved): one layout per page, as extract_page_layout() with
+    a line recognizer would, and one (page_path, figure_paths) per page, or None
+    without `save_folder`.
+    """
+    save = (save_folder, figures) if save_folder else None
+    if keep_pools:
+        tess_pool, trocr_pool = shared_pools(plan)
+        with PageBufferStore(backend) as store:
+            return _run_on_pools(tess_pool, trocr_pool, pages, lang, store, _window(plan), invert, equalize, save)
+    with PageBufferStore(backend) as store, \
+            make_pool("tesseract", plan) as tess_pool, make_pool("trocr", plan) as trocr_pool:
+        return _run_on_pools(tess_pool, trocr_pool, pages, lang, store, _window(plan), invert, equalize, save)
+
+# ========== Auto-tune ==========
+def autotune(sample_path, pages=8, pin=False, lang='eng', invert=False, equalize=False,
+             poppler_path=POPDIR, backend="shm"):
+    """Benchmark candidate_plans() on copies of a sample page; returns the fastest plan.
+
+    `invert` and `equalize` should match the caller the schedule is for
+    (app.py inverts, smart_scan_processor.py equalizes).
+    """
+    if sample_path.lower().endswith(".pdf"):
+        sample = convert_from_path(sample_path, dpi=300, first_page=1, last_page=1, poppler_path=poppler_path)[0]
+    else:
+        sample = Image.open(sample_path).convert("RGB")
+
+    page_imgs = [sample] * pages
+    results = []
+    for plan in candidate_plans(pin=pin):
+        trocr_threads = "+".join(str(w["threads"]) for w in plan["workers"] if w["role"] == "trocr")
+        label = (f"{plan['trocr_replicas']} TrOCR x {trocr_threads} threads, "
+                 f"{plan['tesseract_workers']} Tesseract x {plan['tesseract_threads']} threads")
+        try:
+            with PageBufferStore(backend) as store, \
+                    make_pool("tesseract", plan) as tess_pool, make_pool("trocr", plan) as trocr_pool:
+                # Warm-up pages so model loading in the workers is not timed
+                _run_on_pools(tess_pool, trocr_pool, page_imgs[:plan["trocr_replicas"]], lang, store,
+                              _window(plan), invert, equalize)
+                start = time.perf_counter()
+                _run_on_pools(tess_pool, trocr_pool, page_imgs, lang, store, _window(plan), invert, equalize)
+                elapsed = time.perf_counter() - start
+        except Exception as e:
+            print(f"[X] {label}: {e}")
+            continue
+        pages_per_sec = pages / elapsed
+        print(f"[✓] {label}: {pages_per_sec:.3f} pages/sec")
+        results.append((pages_per_sec, plan))
+
+    if not results:
+        raise RuntimeError("No schedule could be benchmarked")
+    best_rate, best = max(results, key=lambda r: r[0])
+    best["pages_per_sec"] = round(best_rate, 3)
+    return best
+
+# ========== Run ==========
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CPU scheduling for TrOCR replicas and Tesseract workers")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    tune = sub.add_parser("autotune", help="benchmark a sample page and save the fastest schedule")
+    tune.add_argument("sample", help="sample page image or PDF (first page is used)")
+    tune.add_argument("--pages", type=int, default=8, help="pages per benchmark run")
+    tune.add_argument("--pin", action="store_true", help="pin each worker to its cores")
+    tune.add_argument("--lang", default="eng")
+    tune.add_argument("--invert", action="store_true", help="invert pages for Tesseract, as app.py does")
+    tune.add_argument("--equalize", action="store_true", help="equalize TrOCR lines, as smart_scan_processor.py does")
+    tune.add_argument("--buffers", choices=["shm", "mmap"], default="shm", help="page buffer backend")
+    tune.add_argument("--output", default=SCHEDULE_PATH)
+
+    show = sub.add_parser("plan", help="print the schedule for a given split")
+    show.add_argument("trocr_replicas", type=int)
+    show.add_argument("tesseract_workers", type=int)
+    show.add_argument("--tesseract-threads", type=int, default=1)
+    show.add_argument("--pin", action="store_true")
+    show.add_argument("--output", help="also save it as the active schedule")
+
+    args = parser.parse_args()
+    if args.command == "autotune":
+        print(f"🚀 Auto-tuning on {len(available_cores())} cores...")
+        best = autotune(args.sample, pages=args.pages, pin=args.pin, lang=args.lang,
+                        invert=args.invert, equalize=args.equalize, backend=args.buffers)
+        save_schedule(best, args.output)
+        trocr_threads = "+".join(str(w["threads"]) for w in best["workers"] if w["role"] == "trocr")
+        print(f"\n✅ Best: {best['trocr_replicas']} TrOCR replicas x {trocr_threads} threads, "
+              f"{best['tesseract_workers']} Tesseract workers ({best['pages_per_sec']} pages/sec)")
+        print("📂 Schedule:", args.output)
+    else:
+        if min(args.trocr_replicas, args.tesseract_workers, args.tesseract_threads) < 1:
+            parser.error("trocr_replicas, tesseract_workers and --tesseract-threads must be at least 1")
+        plan = plan_schedule(args.trocr_replicas, args.tesseract_workers,
+                             tesseract_threads=args.tesseract_threads, pin=args.pin)
+        json.dump(plan, sys.stdout, indent=2)
+        print()
+        if args.output:
+            save_schedule(plan, args.output)
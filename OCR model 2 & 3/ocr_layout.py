@@ -0,0 +1,304 @@
+import os
+import json
+import html
+import zipfile
+import cv2
+import pytesseract
+from PIL import Image, ImageOps
+from fpdf import FPDF
+
+# Line crops per line-recognizer call (one TrOCR generate per batch)
+LINE_BATCH_SIZE = 16
+
+# Formats produced from a single word-box pass, mapped to their file suffix
+LAYOUT_FORMATS = {
+    "searchable_pdf": ".searchable.pdf",
+    "hocr": ".hocr",
+    "alto": ".alto.xml",
+    "json": ".json",
+}
+
+# ========== Word-box extraction ==========
+def extract_page_layout(page_img, page_number=1, lang='eng', scale=2, invert=False, line_recognizer=None):
+    """Run one Tesseract pass with word coordinates over a page.
+
+    Boxes are returned in the pixel space of `page_img` (the upscale used for
+    Tesseract is divided back out). If `line_recognizer` is given (e.g. TrOCR),
+    each detected line is cropped from the original page and re-read with it,
+    see apply_line_recognizer().
+    """
+    ocr_img = page_img.convert("L")
+    if invert:
+        ocr_img = ImageOps.invert(ocr_img)
+    ocr_img = ocr_img.resize((ocr_img.width * scale, ocr_img.height * scale))
+    data = pytesseract.image_to_data(ocr_img, lang=lang, output_type=pytesseract.Output.DICT)
+
+    lines = {}
+    for i, word in enumerate(data["text"]):
+        word = word.strip()
+        if int(data["level"][i]) != 5 or not word:
+            continue
+        x0 = int(data["left"][i]) // scale
+        y0 = int(data["top"][i]) // scale
+        x1 = (int(data["left"][i]) + int(data["width"][i])) // scale
+        y1 = (int(data["top"][i]) + int(data["height"][i])) // scale
+        key = (int(data["block_num"][i]), int(data["par_num"][i]), int(data["line_num"][i]))
+        lines.setdefault(key, []).append({
+            "text": word,
+            "bbox": [x0, y0, x1, y1],
+            "conf": round(float(data["conf"][i]), 2),
+        })
+
+    page_lines = []
+    for (block, _, _), words in sorted(lines.items()):
+        bbox = [
+            min(w["bbox"][0] for w in words),
+            min(w["bbox"][1] for w in words),
+            max(w["bbox"][2] for w in words),
+            max(w["bbox"][3] for w in words),
+        ]
+        page_lines.append({"block": block, "bbox": bbox, "words": words, "source": "tesseract"})
+
+    layout = {
+        "page": page_number,
+        "width": page_img.width,
+        "height": page_img.height,
+        "lines": page_lines,
+    }
+    if line_recognizer is not None:
+        apply_line_recognizer(page_img, layout, line_recognizer)
+    return layout
+
+def apply_line_recognizer(page_img, layout, line_recognizer, batch_size=LINE_BATCH_SIZE):
+    """Re-read the Tesseract lines of a page with a line recognizer (e.g. TrOCR).
+
+    `line_recognizer` takes a list of line images and returns one string per
+    image, so a page costs one call per `batch_size` lines. Word boxes always
+    stay Tesseract's: if the re-read has as many tokens as Tesseract found
+    words, the tokens go onto those boxes (a changed word loses its Tesseract
+    confidence); otherwise the Tesseract words are kept and the reading is
+    stored on the line as `trocr_text`, which layout_to_text() prefers.
+    Kept separate so the TrOCR stage can run in another worker than Tesseract.
+    """
+    lines = layout["lines"]
+    for start in range(0, len(lines), batch_size):
+        batch = lines[start:start + batch_size]
+        try:
+            texts = line_recognizer([page_img.crop(tuple(line["bbox"])) for line in batch])
+        except Exception as e:
+            print("Line recognizer failed:", e)
+            continue
+        for line, line_text in zip(batch, texts):
+            tokens = line_text.split()
+            if not tokens:
+                continue
+            if len(tokens) == len(line["words"]):
+                for word, token in zip(line["words"], tokens):
+                    if token != word["text"]:
+                        word["text"] = token
+                        word["conf"] = None
+                line["source"] = "trocr"
+            else:
+                line["trocr_text"] = " ".join(tokens)
+    return layout
+
+def layout_to_text(pages):
+    text = ""
+    for page in pages:
+        lines = [line.get("trocr_text") or " ".join(w["text"] for w in line["words"]) for line in page["lines"]]
+        text += f"\n--- Page {page['page']} ---\n" + "\n".join(lines) + "\n"
+    return text.strip()
+
+# ========== Page images ==========
+def find_figures(page_arr):
+    """Picture regions of a page as (contour_index, bbox), found on a uint8 array (read-only is fine)."""
+    gray = cv2.cvtColor(page_arr, cv2.COLOR_RGB2GRAY) if page_arr.ndim == 3 else page_arr
+    blur = cv2.GaussianBlur(gray, (5, 5), 0)
+    _, thresh = cv2.threshold(blur, 180, 255, cv2.THRESH_BINARY_INV)
+    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    figures = []
+    for i, cnt in enumerate(contours):
+        x, y, w, h = cv2.boundingRect(cnt)
+        if w > 100 and h > 100 and h / w < 3:
+            figures.append((i, (x, y, x + w, y + h)))
+    return figures
+
+def save_page_images(page_arr, page_index, folder, figures=False):
+    """Save a page as page_N.png and, with `figures`, its picture regions as pageN_imgK.png.
+
+    Returns (page_path, figure_paths).
+    """
+    page_img = Image.fromarray(page_arr)
+    page_path = os.path.join(folder, f"page_{page_index+1}.png")
+    page_img.save(page_path)
+
+    figure_paths = []
+    if figures:
+        for i, bbox in find_figures(page_arr):
+            out_path = os.path.join(folder, f"page{page_index+1}_img{i+1}.png")
+            page_img.crop(bbox).save(out_path)
+            figure_paths.append(out_path)
+    return page_path, figure_paths
+
+# ========== Output Writers ==========
+def save_layout_json(pages, filename):
+    with open(filename, "w", encoding="utf-8") as f:
+        json.dump({"pages": pages}, f, ensure_ascii=False, indent=2)
+
+def _bbox_title(bbox):
+    return "bbox {} {} {} {}".format(*bbox)
+
+def save_hocr(pages, image_paths, filename):
+    out = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" '
+        '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">',
+        '<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">',
+        '<head>',
+        '  <title></title>',
+        '  <meta http-equiv="Content-Type" content="text/html;charset=utf-8"/>',
+        '  <meta name="ocr-system" content="tesseract + trocr"/>',
+        '  <meta name="ocr-capabilities" content="ocr_page ocr_line ocrx_word"/>',
+        '</head>',
+        '<body>',
+    ]
+    for page, img_path in zip(pages, image_paths):
+        p = page["page"]
+        title = f'image "{os.path.basename(img_path)}"; ' + _bbox_title([0, 0, page["width"], page["height"]])
+        out.append(f"  <div class='ocr_page' id='page_{p}' title='{html.escape(title)}'>")
+        for li, line in enumerate(page["lines"], 1):
+            out.append(f"    <span class='ocr_line' id='line_{p}_{li}' title='{_bbox_title(line['bbox'])}'>")
+            for wi, word in enumerate(line["words"], 1):
+                title = _bbox_title(word["bbox"])
+                if word["conf"] is not None:
+                    title += f"; x_wconf {int(max(word['conf'], 0))}"
+                out.append(
+                    f"      <span class='ocrx_word' id='word_{p}_{li}_{wi}' title='{title}'>"
+                    f"{html.escape(word['text'])}</span>"
+                )
+            out.append("    </span>")
+        out.append("  </div>")
+    out += ["</body>", "</html>"]
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write("\n".join(out) + "\n")
+
+def _alto_box(bbox):
+    x0, y0, x1, y1 = bbox
+    return f'HPOS="{x0}" VPOS="{y0}" WIDTH="{x1 - x0}" HEIGHT="{y1 - y0}"'
+
+def save_alto(pages, image_paths, filename, source_name=None):
+    # ALTO allows a single sourceImageInformation; pages map to images via PHYSICAL_IMG_NR
+    source_name = source_name or (os.path.basename(image_paths[0]) if image_paths else "")
+    out = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<alto xmlns="http://www.loc.gov/standards/alto/ns-v4#" '
+        'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+        'xsi:schemaLocation="http://www.loc.gov/standards/alto/ns-v4# '
+        'http://www.loc.gov/alto/v4/alto-4-2.xsd">',
+        '  <Description>',
+        '    <MeasurementUnit>pixel</MeasurementUnit>',
+        f'    <sourceImageInformation><fileName>{html.escape(source_name)}</fileName></sourceImageInformation>',
+        '  </Description>',
+        '  <Layout>',
+    ]
+    for page in pages:
+        p = page["page"]
+        full = [0, 0, page["width"], page["height"]]
+        out.append(f'    <Page ID="page_{p}" PHYSICAL_IMG_NR="{p}" WIDTH="{page["width"]}" HEIGHT="{page["height"]}">')
+        out.append(f'      <PrintSpace {_alto_box(full)}>')
+
+        blocks = {}
+        for line in page["lines"]:
+            blocks.setdefault(line["block"], []).append(line)
+        li = 0
+        for block, lines in blocks.items():
+            bbox = [
+                min(l["bbox"][0] for l in lines),
+                min(l["bbox"][1] for l in lines),
+                max(l["bbox"][2] for l in lines),
+                max(l["bbox"][3] for l in lines),
+            ]
+            out.append(f'        <TextBlock ID="block_{p}_{block}" {_alto_box(bbox)}>')
+            for line in lines:
+                li += 1
+                out.append(f'          <TextLine ID="line_{p}_{li}" {_alto_box(line["bbox"])}>')
+                for wi, word in enumerate(line["words"], 1):
+                    if wi > 1:
+                        out.append('            <SP/>')
+                    wc = ""
+                    if word["conf"] is not None:
+                        wc = f' WC="{max(word["conf"], 0) / 100:.2f}"'
+                    out.append(
+                        f'            <String ID="string_{p}_{li}_{wi}" {_alto_box(word["bbox"])} '
+                        f'CONTENT="{html.escape(word["text"], quote=True)}"{wc}/>'
+                    )
+                out.append('          </TextLine>')
+            out.append('        </TextBlock>')
+        out += ['      </PrintSpace>', '    </Page>']
+    out += ['  </Layout>', '</alto>']
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write("\n".join(out) + "\n")
+
+def _add_sized_page(pdf, w_pt, h_pt, first_landscape):
+    try:
+        pdf.add_page(format=(w_pt, h_pt))
+    except TypeError:
+        # PyFPDF 1.7 only switches orientation per page; other sizes are scaled to fit
+        pdf.add_page("L" if (w_pt > h_pt) != first_landscape else "P")
+    return pdf.w, pdf.h
+
+def save_searchable_pdf(pages, image_paths, filename, dpi=300, font_path=None):
+    """Page image with an invisible (render mode 3) text layer placed on the word boxes."""
+    if not pages:
+        raise ValueError("A searchable PDF needs at least one page")
+    first = pages[0]
+    first_w = first["width"] * 72.0 / dpi
+    first_h = first["height"] * 72.0 / dpi
+    pdf = FPDF(unit="pt", format=(first_w, first_h))
+    pdf.set_auto_page_break(False)
+    if font_path:
+        pdf.add_font('DejaVu', '', font_path, uni=True)
+        pdf.set_font("DejaVu", size=12)
+    else:
+        pdf.set_font("Arial", size=12)
+
+    for page, img_path in zip(pages, image_paths):
+        # Each PDF page takes its source page's size in points
+        page_w, page_h = _add_sized_page(pdf, page["width"] * 72.0 / dpi, page["height"] * 72.0 / dpi,
+                                         first_w > first_h)
+        k = min(page_w / page["width"], page_h / page["height"])
+        pdf.image(img_path, x=0, y=0, w=page["width"] * k, h=page["height"] * k)
+        pdf._out("3 Tr")
+        for line in page["lines"]:
+            line_h = (line["bbox"][3] - line["bbox"][1]) * k
+            if line_h <= 0:
+                continue
+            pdf.set_font_size(line_h)
+            for word in line["words"]:
+                text = word["text"]
+                if not font_path:
+                    text = text.encode("latin-1", "replace").decode("latin-1")
+                x0, _, x1, _ = word["bbox"]
+                text_w = pdf.get_string_width(text)
+                if text_w <= 0:
+                    continue
+                # Stretch the glyphs horizontally so the selection matches the word box
+                pdf._out(f"{(x1 - x0) * k / text_w * 100:.2f} Tz")
+                pdf.text(x0 * k, line["bbox"][3] * k - line_h * 0.2, text)
+        pdf._out("100 Tz 0 Tr")
+    pdf.output(filename)
+
+def save_layout_outputs(pages, image_paths, base_path, dpi=300, font_path=None, source_name=None):
+    """Write every layout deliverable from the same pages; returns {format: path}."""
+    paths = {fmt: base_path + suffix for fmt, suffix in LAYOUT_FORMATS.items()}
+    save_searchable_pdf(pages, image_paths, paths["searchable_pdf"], dpi=dpi, font_path=font_path)
+    save_hocr(pages, image_paths, paths["hocr"])
+    save_alto(pages, image_paths, paths["alto"], source_name=source_name)
+    save_layout_json(pages, paths["json"])
+    return paths
+
+def save_layout_bundle(paths, filename):
+    with zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED) as zf:
+        for path in paths.values():
+            zf.write(path, arcname=os.path.basename(path))
@@ -0,0 +1,164 @@
+import os
+import sys
+import mmap
+import uuid
+import shutil
+import tempfile
+import threading
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+from PIL import Image
+from pdf2image import convert_from_path, pdfinfo_from_path
+
+# ========== Rasterizing ==========
+def iter_pdf_pages(pdf_path, dpi=300, poppler_path=None):
+    # One page at a time, so only the pages in flight are held in memory
+    info = pdfinfo_from_path(pdf_path, poppler_path=poppler_path)
+    for n in range(1, info["Pages"] + 1):
+        yield convert_from_path(pdf_path, dpi=dpi, first_page=n, last_page=n, poppler_path=poppler_path)[0]
+
+# ========== Handles ==========
+class PageHandle:
+    """Picklable reference to a page buffer; workers call view() for a zero-copy, read-only array."""
+
+    def __init__(self, name, shape, mode, backend, path=None):
+        self.name = name
+        self.shape = tuple(shape)
+        self.mode = mode
+        self.backend = backend
+        self.path = path
+        self._buffer = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_buffer"] = None
+        return state
+
+    def view(self):
+        if self.backend == "shm":
+            if self._buffer is None:
+                self._buffer = _attach_shm(self.name)
+            arr = np.ndarray(self.shape, dtype=np.uint8, buffer=self._buffer.buf)
+            # Other stages read the same page concurrently
+            arr.flags.writeable = False
+            return arr
+        if self._buffer is None:
+            self._buffer = np.memmap(self.path, dtype=np.uint8, mode="r", shape=self.shape)
+        return self._buffer
+
+    def image(self):
+        # For the PIL-based OCR helpers; NumPy/OpenCV stages should use view() directly
+        return Image.fromarray(self.view())
+
+    def close(self):
+        # Drop this process's mapping; the store still owns the buffer
+        if self.backend == "shm" and self._buffer is not None:
+            self._buffer.close()
+        self._buffer = None
+
+def _attach_shm(name):
+    # Only the creating store may unlink, so attaching workers must not track the segment
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args, **kwargs: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+# ========== Store ==========
+class PageBufferStore:
+    """Raw uint8 page buffers shared with worker processes, freed by reference count.
+
+    `put()` takes the number (or list) of stages that will read the page; each
+    stage calls `release()` in the owning process when it is done, and the
+    buffer is unlinked once the count reaches zero.
+    """
+
+    def __init__(self, backend="shm", directory=None):
+        if backend not in ("shm", "mmap"):
+            raise ValueError(f"Unknown page buffer backend: {backend}")
+        self.backend = backend
+        self.directory = directory
+        self._own_directory = False
+        if backend == "mmap" and directory is None:
+            self.directory = tempfile.mkdtemp(prefix="ocr_pages_")
+            self._own_directory = True
+        self._buffers = {}
+        self._lock = threading.Lock()
+
+    def put(self, page_img, stages=1):
+        if page_img.mode not in ("L", "RGB"):
+            page_img = page_img.convert("RGB")
+        src = np.asarray(page_img, dtype=np.uint8)
+        refs = stages if isinstance(stages, int) else len(stages)
+        name = f"ocr_page_{uuid.uuid4().hex[:16]}"
+
+        if self.backend == "shm":
+            buffer = shared_memory.SharedMemory(name=name, create=True, size=max(src.nbytes, 1))
+            np.ndarray(src.shape, dtype=np.uint8, buffer=buffer.buf)[...] = src
+            handle = PageHandle(name, src.shape, page_img.mode, "shm")
+        else:
+            # A plain mmap (not np.memmap) so _free() can close it before deleting the file
+            path = os.path.join(self.directory, name + ".u8")
+            with open(path, "w+b") as f:
+                f.truncate(max(src.nbytes, 1))
+                buffer = mmap.mmap(f.fileno(), max(src.nbytes, 1))
+            np.ndarray(src.shape, dtype=np.uint8, buffer=buffer)[...] = src
+            buffer.flush()
+            handle = PageHandle(name, src.shape, page_img.mode, "mmap", path)
+
+        with self._lock:
+            self._buffers[name] = [buffer, refs, handle.path]
+        return handle
+
+    def acquire(self, handle, count=1):
+        with self._lock:
+            self._buffers[handle.name][1] += count
+
+    def release(self, handle):
+        with self._lock:
+            entry = self._buffers.get(handle.name)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if entry[1] > 0:
+                return
+            buffer, _, path = self._buffers.pop(handle.name)
+        self._free(buffer, path)
+
+    def discard(self, handle):
+        # Free now whatever the count, e.g. when a stage failed and will never release
+        with self._lock:
+            entry = self._buffers.pop(handle.name, None)
+        if entry is not None:
+            self._free(entry[0], entry[2])
+
+    def _free(self, buffer, path):
+        buffer.close()
+        if self.backend == "shm":
+            buffer.unlink()
+        else:
+            try:
+                os.remove(path)
+            except OSError:
+                pass  # still mapped by a worker on Windows; the directory cleanup gets it
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def close(self):
+        with self._lock:
+            entries = list(self._buffers.values())
+            self._buffers.clear()
+        for buffer, _, path in entries:
+            self._free(buffer, path)
+        if self._own_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -4,85 +4,77 @@ import cv2
 import numpy as np
 import pytesseract
 from PIL import Image
-from pdf2image import convert_from_path
 from transformers import TrOCRProcessor, VisionEncoderDecoderModel
 import torch
 from docx import Document
 from fpdf import FPDF
+from cpu_scheduler import load_schedule, run_pipeline
+from page_buffers import iter_pdf_pages
+from ocr_layout import extract_page_layout, layout_to_text, save_layout_outputs, save_page_images
 
 # ========== CONFIG ==========
 PDF_PATH = "China_Janes_Fighting_Ships_2023-2024.pdf"
 POPDIR = r"D:/propeller/poppler-24.08.0/Library/bin"
 OUTPUT_FOLDER = "final_output"
+DPI = 300
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
 # ✅ Tesseract executable path
 pytesseract.pytesseract.tesseract_cmd = r'D:\tesseract\tesseract.exe'
 
-# ========== Load TrOCR ==========
-processor = TrOCRProcessor.from_pretrained("microsoft/trocr-base-printed")
-model = VisionEncoderDecoderModel.from_pretrained("microsoft/trocr-base-printed")
-device = "cuda" if torch.cuda.is_available() else "cpu"
-model.to(device)
+# ========== CPU schedule ==========
+# Saved by `python cpu_scheduler.py autotune --equalize`; when present, pages run through its worker pools
+SCHEDULE = load_schedule()
 
-# ========== OCR with fallback ==========
-def ocr_with_trocr_and_fallback(pil_img):
+# ========== Load TrOCR ==========
+# With a schedule each pool worker loads its own replica instead
+if SCHEDULE is None:
+    processor = TrOCRProcessor.from_pretrained("microsoft/trocr-base-printed")
+    model = VisionEncoderDecoderModel.from_pretrained("microsoft/trocr-base-printed")
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model.to(device)
+
+# ========== TrOCR line reader ==========
+def trocr_read_lines(line_imgs):
     # Preprocess
-    img_gray = pil_img.convert("L").resize((pil_img.width * 2, pil_img.height * 2))
-    img_eq = Image.fromarray(cv2.equalizeHist(np.array(img_gray))).convert("RGB")
-
-    # TrOCR first
-    try:
-        pixel_values = processor(images=img_eq, return_tensors="pt").pixel_values.to(device)
+    batch = []
+    for line_img in line_imgs:
+        img_gray = line_img.convert("L").resize((line_img.width * 2, line_img.height * 2))
+        batch.append(Image.fromarray(cv2.equalizeHist(np.array(img_gray))).convert("RGB"))
+
+    # One generate call for the whole batch of lines
+    pixel_values = processor(images=batch, return_tensors="pt").pixel_values.to(device)
+    with torch.no_grad():
         generated_ids = model.generate(pixel_values)
-        trocr_text = processor.batch_decode(generated_ids, skip_special_tokens=True)[0].strip()
-        if trocr_text:
-            return trocr_text + "  [via TrOCR]"
-    except Exception as e:
-        print("TrOCR failed:", e)
-
-    # Tesseract fallback
-    try:
-        text_fallback = pytesseract.image_to_string(img_gray)
-        return text_fallback.strip() + "  [via Tesseract]"
-    except Exception as e:
-        return "[OCR Failed]"
-
-# ========== Image + Text extraction ==========
-def extract_text_and_images_from_page(pil_img, page_index):
-    text = ocr_with_trocr_and_fallback(pil_img)
-    extracted_images = []
-
-    # Submarine image extraction (v1 logic)
-    img_cv = np.array(pil_img.convert("RGB"))
-    gray = cv2.cvtColor(img_cv, cv2.COLOR_RGB2GRAY)
-    blur = cv2.GaussianBlur(gray, (5, 5), 0)
-    _, thresh = cv2.threshold(blur, 180, 255, cv2.THRESH_BINARY_INV)
-    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-    for i, cnt in enumerate(contours):
-        x, y, w, h = cv2.boundingRect(cnt)
-        if w > 100 and h > 100 and h / w < 3:
-            crop = pil_img.crop((x, y, x + w, y + h))
-            out_path = os.path.join(OUTPUT_FOLDER, f"page{page_index+1}_img{i+1}.png")
-            crop.save(out_path)
-            extracted_images.append(out_path)
-
-    return text.strip(), extracted_images
+    return [t.strip() for t in processor.batch_decode(generated_ids, skip_special_tokens=True)]
 
 # ========== PDF Processor ==========
 def process_pdf(pdf_path):
-    pages = convert_from_path(pdf_path, dpi=300, poppler_path=POPDIR)
-    all_text = ""
+    pages = iter_pdf_pages(pdf_path, dpi=DPI, poppler_path=POPDIR)
+    page_paths = []
     all_images = []
 
-    for i, page_img in enumerate(pages):
-        print(f"📄 Processing Page {i+1}")
-        text, images = extract_text_and_images_from_page(page_img, i)
-        all_text += f"\n--- Page {i+1} ---\n{text}\n"
-        all_images.extend(images)
-
-    return all_text.strip(), all_images
+    def numbered_pages():
+        for i, page_img in enumerate(pages):
+            print(f"📄 Processing Page {i+1}")
+            yield page_img
+
+    # One Tesseract word-box pass per page; TrOCR re-reads each line, Tesseract words are the fallback.
+    # Page PNGs and picture regions (submarine image extraction, v1 logic) come from save_page_images()
+    if SCHEDULE is None:
+        layouts, saved = [], []
+        for i, page_img in enumerate(numbered_pages()):
+            saved.append(save_page_images(np.asarray(page_img), i, OUTPUT_FOLDER, figures=True))
+            layouts.append(extract_page_layout(page_img, page_number=i + 1, line_recognizer=trocr_read_lines))
+    else:
+        # The pool workers save the pages and extract the pictures alongside the OCR stages
+        layouts, saved = run_pipeline(numbered_pages(), SCHEDULE, equalize=True,
+                                      save_folder=OUTPUT_FOLDER, figures=True)
+    for page_path, figure_paths in saved:
+        page_paths.append(page_path)
+        all_images.extend(figure_paths)
+
+    return layout_to_text(layouts), all_images, layouts, page_paths
 
 # ========== Output Writers ==========
 def save_to_txt(text, path):
@@ -113,7 +105,7 @@ def save_to_pdf(text, images, path):
 # ========== Run ==========
 if __name__ == "__main__":
     print("🚀 Starting Smart OCR Scan...")
-    text, images = process_pdf(PDF_PATH)
+    text, images, layouts, page_paths = process_pdf(PDF_PATH)
 
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
     txt_path = os.path.join(OUTPUT_FOLDER, f"output_{timestamp}.txt")
@@ -129,7 +121,20 @@ if __name__ == "__main__":
     print("💾 Saving PDF...")
     save_to_pdf(text, images, pdf_path)
 
+    layout_paths = {}
+    if layouts:
+        print("💾 Saving searchable PDF, hOCR, ALTO and word-box JSON...")
+        layout_paths = save_layout_outputs(layouts, page_paths, os.path.join(OUTPUT_FOLDER, f"output_{timestamp}"),
+                                           dpi=DPI, source_name=os.path.basename(PDF_PATH))
+    else:
+        print("⚠️ The PDF has no pages, skipping searchable PDF, hOCR, ALTO and JSON")
+
     print("\n✅ Done!")
     print("📂 Text:", txt_path)
     print("📂 DOCX:", docx_path)
     print("📂 PDF: ", pdf_path)
+    if layout_paths:
+        print("📂 Searchable PDF:", layout_paths["searchable_pdf"])
+        print("📂 hOCR:", layout_paths["hocr"])
+        print("📂 ALTO:", layout_paths["alto"])
+        print("📂 JSON:", layout_paths["json"])